@@ -7,9 +7,8 @@
 # WARNING! All changes made in this file will be lost!
 
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import QThread
+from PyQt5.QtCore import QThreadPool, QRunnable
 from dynamic_tqdm import *
-from global_dict.w_global import gbl_set_value
 from glue import *
 
 class Ui_Dialog(object):
@@ -826,8 +825,6 @@ class Ui_Dialog(object):
         setup_logging("DeepRad_Tools")
         self.__logger = logging.getLogger("DeepRad_Tools")
         self.__logger.setLevel(logging.DEBUG)
-        self.queue_std_out = config_dict[STDOUT_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QUEUE]
-        self.queue_tqdm = config_dict[TQDM_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QUEUE]
 
         _translate = QtCore.QCoreApplication.translate
 
@@ -848,22 +845,13 @@ class Ui_Dialog(object):
         self.norm_log_tqdm.setGeometry(QtCore.QRect(10, 700, 1201, 21))
         self.norm_log_tqdm.setObjectName("norm_tqdm")
 
-        self.norm_procedure = Wrapper_norm(self.tab_2)
         # self.norm_log_text = StdOutTextEdit(self.tab_2)
         # self.norm_log_tqdm = StdTQDMTextEdit(self.tab_2)
-        self.norm_thread_init = QThread()
-
-        self.norm_text_listener = QThread()
-        self.norm_text_receiver = config_dict[STDOUT_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER]
-        self.norm_tqdm_listener = QThread()
-        self.norm_tqdm_receiver = config_dict[TQDM_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER]
 
         self.set_dynamic_tqdm(log_text=self.norm_log_text,
                               log_bar=self.norm_log_tqdm,
-                              listener_text=self.norm_text_listener,
-                              receiver_text=self.norm_text_receiver,
-                              listener_tqdm=self.norm_tqdm_listener,
-                              receiver_tqdm=self.norm_tqdm_receiver)
+                              stream_text=config.stdout_write_stream,
+                              stream_tqdm=config.tqdm_write_stream)
 
         # # for n2i
 
@@ -872,8 +860,8 @@ class Ui_Dialog(object):
         self.n2i_button_start.setObjectName("n2i_button_start")
         self.n2i_button_start.setText(_translate("Dialog", "Start"))
 
-        self.n2i_log_text = QtWidgets.QTextBrowser(self.tab_3)
-        # self.n2i_log_text = StdOutTextEdit(self.tab_3)
+        # self.n2i_log_text = QtWidgets.QTextBrowser(self.tab_3)
+        self.n2i_log_text = StdOutTextEdit(self.tab_3)
         self.n2i_log_text.setGeometry(QtCore.QRect(690, 40, 521, 551))
         self.n2i_log_text.setObjectName("n2i_logger")
 
@@ -882,28 +870,19 @@ class Ui_Dialog(object):
         self.n2i_log_tqdm.setGeometry(QtCore.QRect(10, 810, 1201, 21))
         self.n2i_log_tqdm.setObjectName("n2i_tqdm")
 
-        # self.n2i_procedure = Wrapper_norm(self.tab_2)
         # # self.norm_log_text = StdOutTextEdit(self.tab_2)
         # # self.norm_log_tqdm = StdTQDMTextEdit(self.tab_2)
-        # self.n2i_thread_init = QThread()
-
-        # self.n2i_text_listener = QThread()
-        # self.n2i_text_receiver = config_dict[STDOUT_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER]
-        # self.n2i_tqdm_listener = QThread()
-        # self.n2i_tqdm_receiver = config_dict[TQDM_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER]
 
         # self.set_dynamic_tqdm(log_text=self.n2i_log_text,
         #                       log_bar=self.n2i_log_tqdm,
-        #                       listener_text=self.n2i_text_listener,
-        #                       receiver_text=self.n2i_text_receiver,
-        #                       listener_tqdm=self.n2i_tqdm_listener,
-        #                       receiver_tqdm=self.n2i_tqdm_receiver)
+        #                       stream_text=config.stdout_write_stream,
+        #                       stream_tqdm=config.tqdm_write_stream)
 
 
 
         # link button to backend
         self.norm_button_start.clicked.connect(self.btn_go_clicked_norm)
-        self.n2i_button_start.clicked.connect(self.n2i_backend)
+        self.n2i_button_start.clicked.connect(self.btn_go_clicked_n2i)
 
 
 
@@ -1068,63 +1047,47 @@ class Ui_Dialog(object):
         self.n2i_folder_output.setPlainText(_translate("Dialog", "./data_output/"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab_3), _translate("Dialog", "nii2img"))
 
-    def n2i_backend(self):
-        gbl_set_value("ui", self)
-        deeprad_backend_n2i()
-
-    def set_dynamic_tqdm(self, log_text, log_bar,
-                         listener_text, receiver_text, listener_tqdm, receiver_tqdm):
-
-        receiver_text.queue_std_out_element_received_signal.connect(log_text.append_text)
-        receiver_text.moveToThread(listener_text)
-        listener_text.started.connect(receiver_text.run)
-        listener_text.start()
+    def set_dynamic_tqdm(self, log_text, log_bar, stream_text, stream_tqdm):
 
-        receiver_tqdm.queue_tqdm_element_received_signal.connect(log_bar.set_tqdm_text)
-        receiver_tqdm.moveToThread(listener_tqdm)
-        listener_tqdm.started.connect(receiver_tqdm.run)
-        listener_tqdm.start()
+        # the streams are written from the processing thread, queued connections deliver the text in the GUI thread
+        stream_text.text_written.connect(log_text.append_text, QtCore.Qt.QueuedConnection)
+        stream_tqdm.text_written.connect(log_bar.set_tqdm_text, QtCore.Qt.QueuedConnection)
 
     def btn_go_clicked_norm(self):
-        procedure_dr = self.norm_procedure
-        thread_dr = self.norm_thread_init
-        button_dr = self.norm_button_start
-        # prepare thread for long operation
-        procedure_dr.moveToThread(thread_dr)
-        gbl_set_value("ui", self)
-        thread_dr.started.connect(self.norm_procedure.run)
-        # start thread
-        button_dr.setEnabled(False)
-        thread_dr.start()
-        button_dr.setEnabled(True)
+        self.start_backend(dr_norm.process_norm, get_norm_args, self.norm_button_start)
 
     def btn_go_clicked_n2i(self):
-        procedure_dr = self.n2i_procedure
-        thread_dr = self.n2i_thread_init
-        button_dr = self.n2i_button_start
-        # prepare thread for long operation
-        procedure_dr.moveToThread(thread_dr)
-        gbl_set_value("ui", self)
-        thread_dr.started.connect(self.n2i_procedure.run)
-        # start thread
-        button_dr.setEnabled(False)
-        thread_dr.start()
-        button_dr.setEnabled(True)
+        self.start_backend(dr_n2i.process_n2i, get_n2i_args, self.n2i_button_start)
 
-class Wrapper_norm(QObject):
-    def __init__(self, main_app):
-        super(Wrapper_norm, self).__init__()
-        self._main_app = main_app
+    def start_backend(self, backend, get_args, button_dr):
+        # the widgets are only read here, in the GUI thread. The processing then runs with these plain
+        # arguments in the global thread pool so the GUI stays responsive, the button is enabled again
+        # when the processing is done
+        try:
+            args = get_args(self)
+        except ValueError:
+            logging.getLogger("DeepRad_Tools").exception('Invalid settings')
+            return
+        procedure_dr = BackendRunnable(backend, args)
+        procedure_dr.signals.finished.connect(lambda: button_dr.setEnabled(True))
+        button_dr.setEnabled(False)
+        QThreadPool.globalInstance().start(procedure_dr)
 
-    @pyqtSlot()
-    def run(self):
-        deeprad_backend_norm()
+class BackendSignals(QObject):
+    finished = pyqtSignal()
 
-class Wrapper_n2i(QObject):
-    def __init__(self, main_app):
-        super(Wrapper_n2i, self).__init__()
-        self._main_app = main_app
+class BackendRunnable(QRunnable):
+    def __init__(self, backend, args):
+        super(BackendRunnable, self).__init__()
+        self.backend = backend
+        self.args = args
+        # the signals object is created in the GUI thread, so connected slots run in the GUI thread
+        self.signals = BackendSignals()
 
-    @pyqtSlot()
     def run(self):
-        deeprad_backend_n2i()
\ No newline at end of file
+        try:
+            self.backend(self.args)
+        except Exception:
+            logging.getLogger("DeepRad_Tools").exception('Processing failed')
+        finally:
+            self.signals.finished.emit()
@@ -64,31 +64,53 @@ Try running deeprad_nii2img --help for specific help and command line options
 # Please see the LICENSE file that should have been included as part of this package
 
 import argparse
+import contextlib
+import functools
 import glob
+import importlib.util
 import logging
-import nibabel
+import logging.handlers
 import numpy as np
 import os
+import queue
+import shutil
+import subprocess
 import sys
-import time
-import copy
+import threading
 import warnings
 import json
 from glob import glob
-from PIL import Image
-from scipy.ndimage import rotate
-from scipy.ndimage.interpolation import shift
-from scipy.ndimage import zoom
-from scipy.ndimage import affine_transform
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 # global variables
 logger = logging.getLogger()
 
+# OpenCV border modes (cv2 attribute names) matching the scipy.ndimage modes accepted by --augmode
+CV2_BORDER_MODES = {
+    'mirror': 'BORDER_REFLECT_101',
+    'nearest': 'BORDER_REPLICATE',
+    'reflect': 'BORDER_REFLECT',
+    'wrap': 'BORDER_WRAP',
+}
+# cv2.warpAffine handles up to 4 channels per call. Note that INTER_LINEAR can round the sample
+# positions to 1/32 of a pixel (always for float64 images, and for float32 images in OpenCV 4.x), so
+# under rotations or scalings the OpenCV output can differ from the exact bilinear interpolation of the
+# numba, scipy and cupy backends by up to ~2e-2 of the local intensity range
+CV2_MAX_CHANNELS = 4
+# --augmode as passed to scipy.ndimage and cupyx.scipy.ndimage. Their 'wrap' mode does not repeat
+# the image with period n (it wraps between the edge pixel centers), 'grid-wrap' does as OpenCV and numba
+SCIPY_BORDER_MODES = {'mirror': 'mirror', 'nearest': 'nearest', 'reflect': 'reflect', 'wrap': 'grid-wrap'}
+# --augmode as passed to the numba kernel
+NUMBA_BORDER_MODES = {'mirror': 0, 'nearest': 1, 'reflect': 2, 'wrap': 3}
+# multithreaded gzip used to decompress .nii.gz files (if installed)
+PIGZ = shutil.which('pigz')
+
 class GuiLogger(logging.Handler):
     def emit(self, record):
-        text = self.edit.toPlainText()+'\n'+self.format(record)
-        self.edit.setPlainText(text)  # implementation of append_line omitted
+        # processing runs in a worker thread, so the widget is never accessed directly: the text is
+        # sent through a signal connected to the widget with a queued connection (see process_n2i)
+        self.stream.write(self.format(record)+'\n')
 
 def arg_parser():
     """
@@ -113,18 +135,23 @@ def arg_parser():
     parser.add_argument('--shuffle', action='store_true', help='Shuffle the order of input data. Use with --augseed to produce different samplings')
     parser.add_argument('--testfraction', type=int, default=0.0, choices=range(0,100,5), help='Fraction of data as an integer percentage that will be used as testing')
     parser.add_argument('--valfraction', type=int, default=0.0, choices=range(0,100,5), help='Fraction of data as an integer percentage that will be used as validation')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used to convert observations (subjects) in parallel')
+    parser.add_argument('--output-format', type=str, default='tiff', choices=['tiff','zarr'],
+                        help='Write one TIFF image per sample, or all samples into a single zarr array (X.zarr/Y.zarr) per output folder')
     auggroup = parser.add_argument_group('Augmentation options')
-    auggroup.add_argument('--augfactor', type=int, default=5, nargs=1, help='The augmentation factor applied. This is how many passes through the data augmentation will perform.')
+    auggroup.add_argument('--augfactor', type=int, default=5, help='The augmentation factor applied. This is how many passes through the data augmentation will perform.')
     auggroup.add_argument('--augmode', type=str, default='reflect', choices=['mirror','nearest','reflect','wrap'],
-                        help='Determines how the augmented data is extended beyond its boundaries. See scipy.ndimage documentation for more information')
-    auggroup.add_argument('--augseed',type=int,nargs=1,default=813,help='Random seed to set for reproducible augmentation')
-    auggroup.add_argument('--addnoise',type=float,nargs=1,default=0,help='Add Gaussian noise by this factor')
+                        help='Determines how the augmented data is extended beyond its boundaries (wrap corresponds to grid-wrap). See scipy.ndimage documentation for more information. '
+                             'When OpenCV is installed, it is used for the interpolation, which may round sample positions to 1/32 of a pixel')
+    auggroup.add_argument('--augseed',type=int,default=813,help='Random seed to set for reproducible augmentation')
+    auggroup.add_argument('--addnoise',type=float,default=0,help='Add Gaussian noise by this factor')
     auggroup.add_argument('--hflips',action='store_true',help='Perform random horizontal flips')
     auggroup.add_argument('--vflips',action='store_true',help='Perform random horizontal flips')
-    auggroup.add_argument('--rotations',type=float,nargs=1,default=0,help='Perform random rotations up to this angle (in degrees)')
-    auggroup.add_argument('--scalings',type=float,nargs=1,default=0,help='Perform random scalings between the range [(1-scale),(1+scale)]')
-    auggroup.add_argument('--shears',type=float,nargs=1,default=0,help='Add random shears by up to this angle (in degrees)')
-    auggroup.add_argument('--translations',type=float,nargs=1,default=0,help='Perform random translations by up to this number of pixels')
+    auggroup.add_argument('--rotations',type=float,default=0,help='Perform random rotations up to this angle (in degrees)')
+    auggroup.add_argument('--scalings',type=float,default=0,help='Perform random scalings between the range [(1-scale),(1+scale)]')
+    auggroup.add_argument('--shears',type=float,default=0,help='Add random shears by up to this angle (in degrees)')
+    auggroup.add_argument('--translations',type=float,default=0,help='Perform random translations by up to this number of pixels')
+    auggroup.add_argument('--device',type=str,default='cpu',choices=['cpu','cuda'],help='Device used for augmentation. cuda requires CuPy and a CUDA capable GPU')
     return parser
 
 def glob_nii(folder):
@@ -173,8 +200,12 @@ def process_n2i(args):
 
     # output log to QT GUI
     if args.log_output is not None:
+        # Qt is only needed for the GUI
+        from PyQt5.QtCore import Qt
+        from dynamic_tqdm import SignalWriteStream
         h = GuiLogger()
-        h.edit = args.log_output  # this should be done in __init__
+        h.stream = SignalWriteStream()  # this should be done in __init__
+        h.stream.text_written.connect(args.log_output.append_text, Qt.QueuedConnection)
         logger.addHandler(h)
     tabs = '---'
 
@@ -184,6 +215,20 @@ def process_n2i(args):
     cmd_line_options = ' '.join(sys.argv[1:])
     logger.info(tabs+'Command line options were: {}'.format(cmd_line_options))
 
+    # augmentation on the GPU requires CuPy
+    if args.device == 'cuda':
+        if importlib.util.find_spec('cupy') is None:
+            err_msg = 'The option --device cuda requires CuPy, which could not be imported.'
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+
+    # writing zarr arrays requires zarr
+    if args.output_format == 'zarr':
+        if importlib.util.find_spec('zarr') is None:
+            err_msg = 'The option --output-format zarr requires zarr, which could not be imported.'
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+
     # get file names and check that we have a similar count
     X_files = [glob_nii(f) for f in args.X]
     num_files = len(X_files[0])
@@ -245,201 +290,494 @@ def process_n2i(args):
     # shuffle input data if requested
     file_order = np.random.permutation(num_files) if args.shuffle else range(num_files)
 
-    check_first_file = True # we want to check the size of the first file to make sure all inputs are consistently sized
-    force_count = 0 # for --force option, keep track of existing files that were skipped to speed up
-    subject_count = 0 # count for file writing
+    # fix the output size to the specified value or to that of the first file
+    if args.imsize is not None:
+        output_shape = args.imsize
+    else:
+        output_shape = get_slice_shape( X_files[0][file_order[0]], args.axes[0] )
+
+    # for --force option, number the subjects after the highest subject number of the existing images
+    force_count = 0
+    if args.force and args.output_format == 'tiff':
+        for root in [X_folder,Y_folder]:
+            for split in ['','train','val','test']:
+                force_count = max( force_count, get_max_subject_count(os.path.join(root,split)) )
+
+    # each observation (subject) is written once per axis. Subjects are numbered in advance so
+    # that they can be processed independently (numbers of skipped subjects are not reused)
+    jobs = []
     for i in range(num_files):
-        for axis in args.axes:
-
-            # read in data
-            curr_X_files = [f[file_order[i]] for f in X_files]
-            curr_Y_files = [f[file_order[i]] for f in Y_files]
-            X_vol = np.stack([get_nii_data(f, logger) for f in curr_X_files])
-            Y_vol = np.stack([get_nii_data(f, logger) for f in curr_Y_files])
-            
-            if X_vol.ndim is 5: # handle 4D inputs
-                X_vol = np.reshape( X_vol, (-1,X_vol.shape[2],X_vol.shape[3],X_vol.shape[4]) )
-            if Y_vol.ndim is 5: # handle 4D inputs
-                Y_vol = np.reshape( Y_vol, (-1,Y_vol.shape[2],Y_vol.shape[3],Y_vol.shape[4]) )
-                
-            print( X_vol.shape )
-            print( Y_vol.shape )
-            
-            # transpose so that the sampled slice is the last dimension
-            if axis == 0:
-                X_vol = np.transpose( X_vol, (0,2,3,1))
-                Y_vol = np.transpose( Y_vol, (0,2,3,1))
-            elif axis == 1:
-                X_vol = np.transpose( X_vol, (0,1,3,2))
-                Y_vol = np.transpose( Y_vol, (0,1,3,2))
-
-            # fix the output size to the specified value or to that of the first file
-            if check_first_file:
-                if args.imsize is not None:
-                    output_shape = args.imsize
-                else:
-                    output_shape = X_vol.shape[1:3]
-                check_first_file = False
-            
-            logger.info(tabs+'X[{}] => Y[{}]'.format(' '.join(curr_X_files),' '.join(curr_Y_files)))
-
-            # check to make sure the data is matching in size, otherwise skip this data
-            if X_vol.shape[1:4] != Y_vol.shape[1:4]:
-                warn_msg = 'Specified X and Y are not identically sized in x,y,z. They must be skipped.'
-                logger.warning(warn_msg)
-                warnings.warn(warn_msg)
-                continue # skip this file
-
-            # the number of samples could vary if there are a different number of slices
-            num_samples = args.augfactor * X_vol.shape[3]
-
-            # keep track of subject count (might not map 1:1 if multiple axes are supplied)
-            subject_count += 1
-
-            for j in tqdm(range(num_samples),desc='{} of {}'.format(i+1,num_files)):
-
-                # get random slice location
-                max_slices = np.max( args.Xslices + args.Yslices )
-                z_loc = np.random.randint( (0+max_slices//2), (X_vol.shape[3]-max_slices//2)-1 )
-                X = get_slice_chunks( X_vol, z_loc, args.Xslices )
-                Y = get_slice_chunks( Y_vol, z_loc, args.Yslices )
-
-                # now flatten so that repeated volumes are in 3rd dimension
-                if np.ndim(X) == 4:
-                    X = np.transpose( X, (1,2,3,0) )
-                X = np.reshape( X, (X.shape[0],X.shape[1],-1), order='F' )
-
-                if np.ndim(Y) == 4:
-                    Y = np.transpose( Y, (1,2,3,0) )
-                Y = np.reshape( Y, (Y.shape[0],Y.shape[1],-1), order='F' )
-
-                # use affine transformations as augmentation
-                M = np.eye(3)
-                # horizontal flips
-                if args.hflips:
-                    M_ = np.eye(3)
-                    M_[1][1] = 1 if np.random.random()<0.5 else -1
-                    M = np.matmul(M,M_)
-                # vertical flips
-                if args.vflips:
-                    M_ = np.eye(3)
-                    M_[0][0] = 1 if np.random.random()<0.5 else -1
-                    M = np.matmul(M,M_)
-                # rotations
-                if np.abs( args.rotations ) > 1e-2:
-                    rot_angle = np.pi/180.0 * np.random.randint(-np.abs(args.rotations),np.abs(args.rotations))
-                    M_ = np.eye(3)
-                    M_[0][0] = np.cos(rot_angle)
-                    M_[0][1] = np.sin(rot_angle)
-                    M_[1][0] = -np.sin(rot_angle)
-                    M_[1][1] = np.cos(rot_angle)
-                    M = np.matmul(M,M_)
-                # shears
-                if np.abs( args.shears ) > 1e-2:
-                    rot_angle_x = np.pi/180.0 * np.random.randint(-np.abs(args.rotations),np.abs(args.rotations))
-                    rot_angle_y = np.pi/180.0 * np.random.randint(-np.abs(args.rotations),np.abs(args.rotations))
-                    M_ = np.eye(3)
-                    M_[0][1] = np.tan(rot_angle_x)
-                    M_[1][0] = np.tan(rot_angle_y)
-                    M = np.matmul(M,M_)                    
-                # scaling (also apply specified resizing [--imsize] here)
-                if np.abs( args.scalings ) > 1e-4 or args.imsize is not None:
-                    if args.imsize is not None:
-                        init_factor_x = X.shape[0] / args.imsize[0]
-                        init_factor_y = X.shape[1] / args.imsize[1]
-                    else:
-                        init_factor_x = 1
-                        init_factor_y = 1
-                    if np.abs( args.scalings ) > 1e-4:
-                        random_factor_x = np.random.randint(-np.abs(args.scalings)*10000,np.abs(args.scalings)*10000)/10000
-                        random_factor_y = np.random.randint(-np.abs(args.scalings)*10000,np.abs(args.scalings)*10000)/10000
-                    else:
-                        random_factor_x = 0
-                        random_factor_y = 0
-                    scale_factor_x = init_factor_x + random_factor_x
-                    scale_factor_y = init_factor_y + random_factor_y
-                    M_ = np.eye(3)
-                    M_[0][0] = scale_factor_x
-                    M_[1][1] = scale_factor_y
-                    M = np.matmul(M,M_)
-                # translations
-                if np.abs( args.translations ) > 0:
-                    translate_x = np.random.randint( -np.abs( args.translations ), np.abs( args.translations ) )
-                    translate_y = np.random.randint( -np.abs( args.translations ), np.abs( args.translations ) )
-                    M_ = np.eye(3)
-                    M_[0][2] = translate_x
-                    M_[1][2] = translate_y
-                    M = np.matmul(M,M_)
-
-                # now apply the transform
-                X_ = np.zeros( (output_shape[0],output_shape[1],X.shape[2]), dtype=X.dtype )
-                Y_ = np.zeros( (output_shape[0],output_shape[1],Y.shape[2]), dtype=Y.dtype )
-                for k in range(X.shape[2]):
-                    X_[:,:,k] = affine_transform( X[:,:,k], M, output_shape=output_shape, mode=args.augmode )
-                for k in range(Y.shape[2]):
-                    Y_[:,:,k] = affine_transform( Y[:,:,k], M, output_shape=output_shape, mode=args.augmode )
-                X = X_
-                Y = Y_
-
-                # optionally add noise
-                if np.abs( args.addnoise ) > 1e-10:
-                    noise_mean = 0
-                    noise_sigma = args.addnoise
-                    noise = np.random.normal( noise_mean, noise_sigma, output_shape )
-                    for k in range(X.shape[2]):
-                        X[:,:,k] = X[:,:,k] + noise
-                    for k in range(Y.shape[2]):
-                        Y[:,:,k] = Y[:,:,k] + noise
-
-                # flatten samples into 2d data
-                X = np.reshape( X, (X.shape[0],-1), order='F' )
-                Y = np.reshape( Y, (X.shape[0],-1), order='F' )
-
-                # transform the images to 32-bit float
-                X = np.array(X, dtype=np.float32)
-                Y = np.array(Y, dtype=np.float32)                
-
-                # create PIL images and write to disk
-                Ximage = Image.fromarray(X,mode='F')
-                Yimage = Image.fromarray(Y,mode='F')
-
-                # # save as a npy to see the result
-                # Ximage = copy.deepcopy(X)
-                # Yimage = copy.deepcopy(Y)
+        curr_X_files = [f[file_order[i]] for f in X_files]
+        curr_Y_files = [f[file_order[i]] for f in Y_files]
+        axis_jobs = [ (axis, force_count+i*len(args.axes)+k+1, 0) for k,axis in enumerate(args.axes) ]
+        jobs.append( (i, axis_jobs, curr_X_files, curr_Y_files) )
+
+    # zarr arrays hold all samples of an output folder, so the rows of each observation are assigned in advance
+    if args.output_format == 'zarr':
+        jobs = create_zarr_stores( args, jobs, output_shape, num_files, logger )
+
+    # the GUI log widget cannot be passed to worker processes
+    job_args = argparse.Namespace(**{k:v for k,v in vars(args).items() if k != 'log_output'})
+    subject_fn = functools.partial( process_subject, job_args, output_shape, num_files )
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for records in executor.map( subject_fn, jobs, chunksize=1 ):
+                for record in records:
+                    logger.handle(record)
+    else:
+        # read the next observation in the background while the current one is augmented. Closing the
+        # generator (also when process_subject raises) stops the background thread
+        with contextlib.closing( prefetch_subjects( jobs, logger ) ) as prefetched:
+            for job, volumes in prefetched:
+                for record in subject_fn( job, volumes ):
+                    logger.handle(record)
+
+    logger.info(tabs+'Completed!\n\n\n')
+
+
+def process_subject( args, output_shape, num_files, job, volumes=None ):
+    """
+    Function to write the augmented samples of one observation (subject) sampled along each of the
+    requested axes. The data is read once for all axes. This runs in a worker process when --workers
+    is greater than 1
+
+    Parameters
+        args: The command line options (see arg_parser)
+        output_shape: The size (H x W) of the images that are written
+        num_files: The number of observations (subjects)
+        job: A tuple (i, axis_jobs, curr_X_files, curr_Y_files) with the index of the observation,
+            a list of (axis, subject_count, sample_offset) tuples with the axes on which to sample the
+            slices, the subject numbers used in the output file names and the first rows written in
+            the zarr arrays (--output-format zarr), and the input (X) and target (Y) files
+        volumes: The (X_vol, Y_vol) data of the observation if it was already read (see load_subject)
+
+    Returns
+        The log records of this observation, to be handled by the logger of the main process
+    """
+    i, axis_jobs, curr_X_files, curr_Y_files = job
+    tabs = '---'
+
+    # collect log messages so they can be passed back to the main process
+    log = logging.handlers.BufferingHandler(sys.maxsize)
+    logger = logging.Logger(__name__)
+    logger.addHandler(log)
+
+    # array module used for augmentation (numpy or cupy)
+    if args.device == 'cuda':
+        import cupy
+        xp = cupy
+    else:
+        xp = np
+
+    # read in data
+    if volumes is None:
+        volumes = load_subject( curr_X_files, curr_Y_files, logger )
+    X_vol, Y_vol = volumes
+
+    print( X_vol.shape )
+    print( Y_vol.shape )
+
+    # upload the volumes once so all samples are augmented on the device
+    X_vol = xp.asarray(X_vol)
+    Y_vol = xp.asarray(Y_vol)
+
+    # open the zarr arrays of the output folder of this observation
+    curr_X_folder, curr_Y_folder = get_output_folders( args, i, num_files )
+    if args.output_format == 'zarr':
+        import zarr
+        X_store = zarr.open( os.path.join(curr_X_folder,'X.zarr'), mode='r+' )
+        Y_store = zarr.open( os.path.join(curr_Y_folder,'Y.zarr'), mode='r+' )
+    elif args.force:
+        # list the existing images once instead of checking every output path
+        existing_X = set(os.listdir(curr_X_folder))
+        existing_Y = set(os.listdir(curr_Y_folder))
+
+    # augmentation ranges, the same for all samples (a range of 0 leaves the sample unchanged)
+    max_slices = max( args.Xslices, args.Yslices )
+    rot_range = np.pi/180.0 * abs(args.rotations) if abs(args.rotations) > 1e-2 else 0.0
+    shear_range = np.pi/180.0 * abs(args.shears) if abs(args.shears) > 1e-2 else 0.0
+    scale_range = abs(args.scalings) if abs(args.scalings) > 1e-4 else 0.0
+    translate_range = abs(args.translations)
+
+    # the noise image is drawn into the same buffer for every sample
+    if abs(args.addnoise) > 1e-10:
+        noise_sigma = np.float32( args.addnoise )
+        noise = xp.empty( (output_shape[0],output_shape[1],1), dtype=np.float32 )
+    else:
+        noise = None
+
+    for axis, subject_count, sample_offset in axis_jobs:
+
+        # seed each observation and axis separately so the output does not depend on the order of processing
+        seed = args.augseed + i*31 + axis
+        rng = np.random.default_rng(seed)
+        xp_rng = rng if xp is np else xp.random.default_rng(seed)
+
+        # transpose so that the sampled slice is the last dimension (a view, the data is not copied)
+        if axis == 0:
+            X_ax = np.transpose( X_vol, (0,2,3,1))
+            Y_ax = np.transpose( Y_vol, (0,2,3,1))
+        elif axis == 1:
+            X_ax = np.transpose( X_vol, (0,1,3,2))
+            Y_ax = np.transpose( Y_vol, (0,1,3,2))
+        else:
+            X_ax = X_vol
+            Y_ax = Y_vol
+
+        logger.info(tabs+'X[{}] => Y[{}]'.format(' '.join(curr_X_files),' '.join(curr_Y_files)))
+
+        # check to make sure the data is matching in size, otherwise skip this data
+        if X_ax.shape[1:4] != Y_ax.shape[1:4]:
+            warn_msg = 'Specified X and Y are not identically sized in x,y,z. They must be skipped.'
+            logger.warning(warn_msg)
+            warnings.warn(warn_msg)
+            continue # skip this axis
+
+        # every sampled chunk must fit in the volume, otherwise skip this data
+        if X_ax.shape[3] < max_slices:
+            warn_msg = 'Specified X and Y have fewer than {} slices along axis {}. They must be skipped.'.format(max_slices,axis)
+            logger.warning(warn_msg)
+            warnings.warn(warn_msg)
+            continue # skip this axis
+
+        # the number of samples could vary if there are a different number of slices
+        num_samples = args.augfactor * X_ax.shape[3]
+        # centers of the chunks (see get_slice_chunks), the upper bound is excluded by rng.integers
+        z_range = ( max_slices//2, X_ax.shape[3]-max_slices//2 )
+
+        # the output file names of this axis only differ in the sample number
+        X_prefix = 'X_{:05d}_'.format(subject_count)
+        Y_prefix = 'Y_{:05d}_'.format(subject_count)
+
+        # also apply specified resizing [--imsize] with the scaling
+        if args.imsize is not None:
+            scale_x, scale_y = X_ax.shape[1] / args.imsize[0], X_ax.shape[2] / args.imsize[1]
+        else:
+            scale_x, scale_y = 1.0, 1.0
+
+        for j in tqdm(range(num_samples),desc='{} of {}'.format(i+1,num_files)):
+
+            # draw all random numbers of this sample at once, uniform in [-1,1): flips (0,1),
+            # rotation (2), shears (3,4), scalings (5,6) and translations (7,8)
+            u = 2*rng.random(9, dtype=np.float32) - 1
+
+            # get random slice location
+            z_loc = rng.integers( z_range[0], z_range[1] )
+            X = get_slice_chunks( X_ax, z_loc, args.Xslices )
+            Y = get_slice_chunks( Y_ax, z_loc, args.Yslices )
+
+            # now flatten so that repeated volumes are in 3rd dimension (volume-major, slice-minor)
+            X = np.transpose( X, (1,2,0,3) ).reshape( X.shape[1], X.shape[2], -1 )
+            Y = np.transpose( Y, (1,2,0,3) ).reshape( Y.shape[1], Y.shape[2], -1 )
+
+            # draw the random parameters of the affine transformation (the identity if no augmentation is requested)
+            hflip = -1 if args.hflips and u[0] >= 0 else 1
+            vflip = -1 if args.vflips and u[1] >= 0 else 1
+            rot_angle = rot_range * u[2]
+            shear_angle_x = shear_range * u[3]
+            shear_angle_y = shear_range * u[4]
+            scale_factor_x = scale_x + scale_range * u[5]
+            scale_factor_y = scale_y + scale_range * u[6]
+            translate_x = translate_range * u[7]
+            translate_y = translate_range * u[8]
+
+            # use affine transformations as augmentation. M is the closed form of the product
+            # flips @ rotation @ shear @ scaling @ translation
+            cos_rot, sin_rot = np.cos(rot_angle), np.sin(rot_angle)
+            tan_x, tan_y = np.tan(shear_angle_x), np.tan(shear_angle_y)
+            m00 = vflip * (cos_rot + sin_rot*tan_y) * scale_factor_x
+            m01 = vflip * (cos_rot*tan_x + sin_rot) * scale_factor_y
+            m10 = hflip * (cos_rot*tan_y - sin_rot) * scale_factor_x
+            m11 = hflip * (cos_rot - sin_rot*tan_x) * scale_factor_y
+            M = np.array( [[m00, m01, m00*translate_x + m01*translate_y],
+                           [m10, m11, m10*translate_x + m11*translate_y],
+                           [0, 0, 1]] )
+
+            # now apply the transform
+            X = warp_slices( X, M, output_shape, args.augmode )
+            Y = warp_slices( Y, M, output_shape, args.augmode )
+
+            # transform the images to 32-bit float (no copy if they already are)
+            X = X.astype(np.float32, copy=False)
+            Y = Y.astype(np.float32, copy=False)
+
+            # optionally add noise (the same noise image is broadcast to every slice)
+            if noise is not None:
+                xp_rng.standard_normal( dtype=np.float32, out=noise )
+                noise *= noise_sigma
+                X += noise
+                Y += noise
+
+            # copy back from the device for writing
+            if xp is not np:
+                X = xp.asnumpy(X)
+                Y = xp.asnumpy(Y)
+
+            if args.output_format == 'zarr':
+                # write the sample into its row of the zarr arrays
+                X_store[sample_offset+j] = X
+                Y_store[sample_offset+j] = Y
+            else:
+                # flatten samples into 2d data (the slices are tiled horizontally)
+                X = X.transpose(0,2,1).reshape( X.shape[0], -1 )
+                Y = Y.transpose(0,2,1).reshape( Y.shape[0], -1 )
 
                 # determine full output image path
-                if not do_testdata and not do_valdata:
-                    curr_X_folder = X_folder
-                    curr_Y_folder = Y_folder
-                elif do_testdata and (100*i/num_files > (100-args.testfraction)):
-                    curr_X_folder = os.path.join(X_folder,'test')
-                    curr_Y_folder = os.path.join(Y_folder,'test')
-                elif do_valdata and (100*i/num_files > (100-args.valfraction-args.testfraction)):
-                    curr_X_folder = os.path.join(X_folder,'val')
-                    curr_Y_folder = os.path.join(Y_folder,'val')
-                else:
-                    curr_X_folder = os.path.join(X_folder,'train')
-                    curr_Y_folder = os.path.join(Y_folder,'train')
-
-                Ximage_path = os.path.join(curr_X_folder,'X_{:05d}_{:08d}.tiff'.format(subject_count,j+1))
-                Yimage_path = os.path.join(curr_Y_folder,'Y_{:05d}_{:08d}.tiff'.format(subject_count,j+1))
+                Ximage_name = '{}{:08d}.tiff'.format(X_prefix,j+1)
+                Yimage_name = '{}{:08d}.tiff'.format(Y_prefix,j+1)
                 if args.force:
-                    # user specified force, now we will have to check if the file exists before writing to it                    
-                    while os.path.exists(Ximage_path) or os.path.exists(Yimage_path):
-                        force_count += 1 
-                        Ximage_path = os.path.join(curr_X_folder,'X_{:05d}_{:08d}.tiff'.format(subject_count+force_count,j+1))
-                        Yimage_path = os.path.join(curr_Y_folder,'Y_{:05d}_{:08d}.tiff'.format(subject_count+force_count,j+1))                          
-                
-                # write image file to disk 
-                Ximage.save(Ximage_path)
-                Yimage.save(Yimage_path)
+                    # user specified force, now we will have to check if the file exists before writing to it
+                    force_count = 0
+                    while Ximage_name in existing_X or Yimage_name in existing_Y:
+                        force_count += 1
+                        Ximage_name = 'X_{:05d}_{:08d}.tiff'.format(subject_count+force_count,j+1)
+                        Yimage_name = 'Y_{:05d}_{:08d}.tiff'.format(subject_count+force_count,j+1)
+                Ximage_path = os.path.join(curr_X_folder,Ximage_name)
+                Yimage_path = os.path.join(curr_Y_folder,Yimage_name)
+
+                # write image file to disk
+                write_tiff( Ximage_path, X )
+                write_tiff( Yimage_path, Y )
 
                 # # save as npy
                 # np.save(Ximage_path, Ximage)
                 # np.save(Yimage_path, Yimage)
 
+    return log.buffer
 
-    logger.info(tabs+'Completed!\n\n\n')
+
+def load_subject( curr_X_files, curr_Y_files, logger ):
+    """
+    Function to read and normalize the data of one observation (subject)
+
+    Parameters
+        curr_X_files: The input (X) files of the observation
+        curr_Y_files: The target (Y) files of the observation
+        logger: The logger used for warnings
+
+    Returns
+        A tuple (X_vol, Y_vol) of 4D arrays with the files (and 4D volumes) stacked in the first dimension
+    """
+    return stack_nii_data( curr_X_files, logger ), stack_nii_data( curr_Y_files, logger )
+
+
+def stack_nii_data( files, logger ):
+    """
+    Function to read the NifTI data of several files into one preallocated array, so that the
+    data of all files is not held twice while stacking
+
+    Parameters
+        files: The input file names of the NifTI images (.nii or .nii.gz files)
+        logger: The logger used for warnings
+
+    Returns
+        A 4D array with the files (and 4D volumes) stacked in the first dimension
+    """
+    import nibabel
+
+    shapes = [ nibabel.load(fn).shape for fn in files ]
+    num_volumes = [ shape[3] if len(shape) > 3 else 1 for shape in shapes ]
+    vol = np.empty( (sum(num_volumes),)+tuple(shapes[0][:3]), dtype=np.float32 )
+    k = 0
+    for fn, n in zip(files, num_volumes):
+        vol[k:k+n] = np.reshape( get_nii_data(fn, logger), (n,)+vol.shape[1:] )
+        k += n
+
+    return vol
+
+
+def prefetch_subjects( jobs, logger, maxsize=2 ):
+    """
+    Generator that reads the data of the passed jobs in a background thread, so that decompressing
+    the next NifTI files overlaps with the augmentation of the current observation
+
+    Parameters
+        jobs: The jobs as passed to process_subject
+        logger: The logger used for warnings
+        maxsize: The maximum number of observations that are read ahead
+
+    Returns
+        Tuples (job, volumes) in the order of jobs, with volumes as returned by load_subject
+    """
+    prefetched = queue.Queue(maxsize=maxsize)
+    # set when the consumer stops early (e.g. process_subject raised), so the producer stops reading
+    # observations and does not block forever on the full queue
+    stop = threading.Event()
+
+    def put( item ):
+        # returns False if the consumer stopped before the item could be queued
+        while not stop.is_set():
+            try:
+                prefetched.put( item, timeout=0.1 )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for job in jobs:
+                if stop.is_set() or not put( (job, load_subject(job[2], job[3], logger)) ):
+                    return
+        except Exception as e: # re-raised in the main thread
+            put( (None, e) )
+        else:
+            put( (None, None) )
+
+    threading.Thread( target=producer, daemon=True ).start()
+    try:
+        while True:
+            job, volumes = prefetched.get()
+            if job is None:
+                if volumes is not None:
+                    raise volumes
+                return
+            yield job, volumes
+    finally:
+        stop.set()
+        # release the volumes that were read ahead and unblock the producer
+        while True:
+            try:
+                prefetched.get_nowait()
+            except queue.Empty:
+                break
+
+
+def get_output_folders( args, i, num_files ):
+    """
+    Function to return the output folders of an observation (subject) given the testing and validation fractions
+
+    Parameters
+        args: The command line options (see arg_parser)
+        i: The index of the observation
+        num_files: The number of observations (subjects)
+
+    Returns
+        The output folders of the input (X) and target (Y) data of the observation
+    """
+    X_folder = os.path.join(args.outfolder,'X')
+    Y_folder = os.path.join(args.outfolder,'Y')
+    do_testdata = True if (args.testfraction>0) else False
+    do_valdata = True if (args.valfraction>0) else False
+    if not do_testdata and not do_valdata:
+        return X_folder, Y_folder
+    elif do_testdata and (100*i/num_files > (100-args.testfraction)):
+        split = 'test'
+    elif do_valdata and (100*i/num_files > (100-args.valfraction-args.testfraction)):
+        split = 'val'
+    else:
+        split = 'train'
+    return os.path.join(X_folder,split), os.path.join(Y_folder,split)
+
+
+def get_max_subject_count( folder ):
+    """
+    Function to return the highest subject number of the images (X_SSSSS_NNNNNNNN.tiff) in a folder
+
+    Parameters
+        folder: The output folder to scan
+
+    Returns
+        The highest subject number found, or 0 if there are no images (or no folder)
+    """
+    if not os.path.isdir(folder):
+        return 0
+    max_count = 0
+    for fn in os.listdir(folder):
+        parts = fn.split('_')
+        if fn.endswith('.tiff') and len(parts) == 3 and parts[1].isdigit():
+            max_count = max( max_count, int(parts[1]) )
+    return max_count
+
+
+def create_zarr_stores( args, jobs, output_shape, num_files, logger ):
+    """
+    Function to create the zarr arrays (X.zarr and Y.zarr) of each output folder and to assign
+    the rows written by each observation (subject). The number of samples is determined from
+    the NifTI headers, so no pixel data is read. With --force, samples are appended to existing arrays
+
+    Parameters
+        args: The command line options (see arg_parser)
+        jobs: The list of jobs as passed to process_subject
+        output_shape: The size (H x W) of the images that are written
+        num_files: The number of observations (subjects)
+        logger: The logger used for progress messages and errors
+
+    Returns
+        The list of jobs with the sample offsets filled in
+    """
+    import zarr
+    import nibabel
+
+    tabs = '---'
+    num_samples = {}
+    new_jobs = []
+    for i, axis_jobs, curr_X_files, curr_Y_files in jobs:
+        folders = get_output_folders( args, i, num_files )
+        X_shapes = [ nibabel.load(fn).shape for fn in curr_X_files ]
+        Y_shapes = [ nibabel.load(fn).shape for fn in curr_Y_files ]
+        X_channels = args.Xslices * sum( shape[3] if len(shape) > 3 else 1 for shape in X_shapes )
+        Y_channels = args.Yslices * sum( shape[3] if len(shape) > 3 else 1 for shape in Y_shapes )
+        if folders not in num_samples:
+            num_samples[folders] = [0, X_channels, Y_channels]
+        elif num_samples[folders][1:] != [X_channels, Y_channels]:
+            err_msg = 'X[{}] => Y[{}] do not have the same number of volumes as the other observations.'.format(' '.join(curr_X_files),' '.join(curr_Y_files))
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+        new_axis_jobs = []
+        for axis, subject_count, _ in axis_jobs:
+            new_axis_jobs.append( (axis, subject_count, num_samples[folders][0]) )
+            # observations that are skipped in process_subject (mismatched sizes) do not write any samples
+            if X_shapes[0][:3] == Y_shapes[0][:3]:
+                num_samples[folders][0] += args.augfactor * X_shapes[0][axis]
+        new_jobs.append( (i, new_axis_jobs, curr_X_files, curr_Y_files) )
+
+    offsets = {}
+    for (curr_X_folder, curr_Y_folder), (count, X_channels, Y_channels) in num_samples.items():
+        offset = 0
+        for folder, name, channels in [(curr_X_folder,'X',X_channels),(curr_Y_folder,'Y',Y_channels)]:
+            fn = os.path.join(folder,name+'.zarr')
+            shape = (output_shape[0],output_shape[1],channels)
+            if args.force and os.path.isdir(fn):
+                store = zarr.open( fn, mode='r+' )
+                if store.shape[1:] != shape:
+                    err_msg = 'The existing samples in {} are sized {}. I expected {}.'.format(fn,store.shape[1:],shape)
+                    logger.error(err_msg)
+                    raise ValueError(err_msg)
+                offset = max( offset, store.shape[0] )
+            else:
+                zarr.open( fn, mode='w', shape=(0,)+shape, chunks=(1,)+shape, dtype='float32' )
+        # X and Y rows must match, so both arrays are extended from the longest one
+        for folder, name in [(curr_X_folder,'X'),(curr_Y_folder,'Y')]:
+            store = zarr.open( os.path.join(folder,name+'.zarr'), mode='r+' )
+            store.resize( (offset+count,)+store.shape[1:] )
+        logger.info(tabs+'Writing {} samples into {}'.format(count,os.path.join(curr_X_folder,'X.zarr')))
+        offsets[(curr_X_folder,curr_Y_folder)] = offset
+
+    jobs = []
+    for i, axis_jobs, curr_X_files, curr_Y_files in new_jobs:
+        offset = offsets[get_output_folders( args, i, num_files )]
+        axis_jobs = [ (axis, subject_count, offset+sample_offset) for axis, subject_count, sample_offset in axis_jobs ]
+        jobs.append( (i, axis_jobs, curr_X_files, curr_Y_files) )
+
+    return jobs
+
+
+def get_slice_shape( fn, axis ):
+    """
+    Function to return the size of the 2D slices of a NifTI image without reading its pixel data
+
+    Parameters
+        fn: The input file name of the NifTI image (.nii or .nii.gz file)
+        axis: The axis on which the slices are sampled
+
+    Returns
+        The size of the sampled slices
+    """
+    import nibabel
+
+    shape = nibabel.load(fn).shape[:3]
+    return tuple( shape[k] for k in range(3) if k != axis )
 
 
 def get_slice_chunks( img, z_loc, num_slices ):
@@ -452,17 +790,117 @@ def get_slice_chunks( img, z_loc, num_slices ):
         num_slices: The number of slices to sample. This should be an odd number
 
     Returns
-        A chunk of 1 or more slices from the passed input
+        A chunk of num_slices slices centered on z_loc from the passed input (a view, the data is not copied)
     """
-    if num_slices == 1:
-        out = img[:,:,:,z_loc]
-        out = np.expand_dims(out,3)
-    else:
-        out = img[:,:,:,(z_loc-num_slices//2-1):(z_loc+num_slices//2)]
+    half = num_slices//2
+    return img[:,:,:,(z_loc-half):(z_loc+half+1)]
+
+
+@functools.lru_cache(maxsize=None)
+def import_optional( name ):
+    """
+    Function to import an optional module on first use. Importing deeprad_nii2img (e.g. for --help)
+    then does not pay for the accelerators (OpenCV, numba, tifffile) that are only needed to write samples
+
+    Parameters
+        name: The name of the module
+
+    Returns
+        The imported module, or None if it could not be imported
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
 
+def warp_slices( img, M, output_shape, mode ):
+    """
+    Function to apply the same affine transformation to every slice of a stack of 2D images
+
+    Parameters
+        img: The stack of 2D images with the slices in the last dimension (H x W x K)
+        M: The 3x3 affine matrix mapping output to input pixel coordinates (as in scipy.ndimage.affine_transform)
+        output_shape: The size (H x W) of the transformed images
+        mode: Determines how the data is extended beyond its boundaries (see --augmode)
+
+    Returns
+        The transformed stack of 2D images (output_shape[0] x output_shape[1] x K)
+    """
+    if not isinstance(img, np.ndarray):
+        # CuPy array (--device cuda): transform all slices in one call, leaving the slice dimension untouched
+        import cupy
+        from cupyx.scipy.ndimage import affine_transform as cupy_affine_transform
+        M_3d = cupy.asarray( [[M[0][0],M[0][1],0,M[0][2]],
+                              [M[1][0],M[1][1],0,M[1][2]],
+                              [0,0,1,0],
+                              [0,0,0,1]] )
+        return cupy_affine_transform( img, M_3d, output_shape=(output_shape[0],output_shape[1],img.shape[2]), order=1, mode=SCIPY_BORDER_MODES[mode] )
+
+    cv2 = import_optional('cv2')
+    if cv2 is None:
+        # the numba kernel is used when OpenCV is not installed
+        numba_kernels = import_optional('deeprad_nii2img_numba')
+        if numba_kernels is not None:
+            return numba_kernels.warp_slices_numba( np.ascontiguousarray(img), np.asarray(M,dtype=np.float64), output_shape[0], output_shape[1], NUMBA_BORDER_MODES[mode] )
+
+    # every slice of the output is written below, so it does not need to be initialized
+    out = np.empty( (output_shape[0],output_shape[1],img.shape[2]), dtype=img.dtype )
+    if cv2 is not None:
+        # OpenCV indexes pixels as (x,y)=(column,row), so swap the row and column terms of M.
+        # WARP_INVERSE_MAP keeps the output-to-input mapping of scipy so M is used as-is
+        M_cv = np.array( [[M[1][1],M[1][0],M[1][2]],
+                          [M[0][1],M[0][0],M[0][2]]], dtype=np.float64 )
+        img = np.ascontiguousarray(img)
+        for k in range(0,img.shape[2],CV2_MAX_CHANNELS):
+            chunk = cv2.warpAffine( img[:,:,k:k+CV2_MAX_CHANNELS], M_cv, (output_shape[1],output_shape[0]),
+                                    flags=cv2.INTER_LINEAR|cv2.WARP_INVERSE_MAP, borderMode=getattr(cv2,CV2_BORDER_MODES[mode]) )
+            out[:,:,k:k+CV2_MAX_CHANNELS] = np.reshape( chunk, (output_shape[0],output_shape[1],-1) )
+    else:
+        from scipy.ndimage import affine_transform
+        for k in range(img.shape[2]):
+            out[:,:,k] = affine_transform( img[:,:,k], M, output_shape=output_shape, order=1, mode=SCIPY_BORDER_MODES[mode] )
     return out
 
 
+def write_tiff( fn, img ):
+    """
+    Function to write a 2D image to disk as an uncompressed 32-bit floating point TIFF file
+
+    Parameters
+        fn: The output file name of the TIFF image
+        img: The 2D image data (float32)
+    """
+    tifffile = import_optional('tifffile')
+    if tifffile is not None:
+        tifffile.imwrite( fn, img, dtype=np.float32, photometric='minisblack', compression=None, predictor=False, bigtiff=False )
+    else:
+        from PIL import Image
+        Image.fromarray(img,mode='F').save(fn)
+
+
+def load_nii( fn ):
+    """
+    Function to load a NifTI image. Compressed files (.nii.gz) are decompressed with pigz if it is
+    installed, uncompressed files (.nii) are memory mapped
+
+    Parameters
+        fn: The input file name of the NifTI image (.nii or .nii.gz file)
+
+    Returns
+        The NifTI image (nibabel.Nifti1Image)
+    """
+    import nibabel
+
+    if PIGZ is not None and fn.endswith('.gz'):
+        try:
+            raw = subprocess.run( [PIGZ,'-dc',fn], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True ).stdout
+            return nibabel.Nifti1Image.from_bytes(raw)
+        except (OSError, subprocess.CalledProcessError, nibabel.spatialimages.HeaderDataError):
+            pass # fall back to nibabel (e.g. NifTI-2 files)
+    return nibabel.load(fn, mmap=True)
+
+
 def get_nii_data(fn, logger):
     """
     Function to load NifTI data from the passed filename and apply DeepRad normalization (from deeprad_normalize)
@@ -473,28 +911,35 @@ def get_nii_data(fn, logger):
     Returns
         The image pixel data with DeepRad normalization applied (as calculated using deeprad_normalize)
     """
-    nii = nibabel.load(fn)
-
-    # read image data from file
-    data = nii.get_fdata().astype(np.float32)
-    
-    if data.ndim is 4: # handle 4D input files
-        data = np.transpose( data, (3,0,1,2))
+    nii = load_nii(fn)
 
     # read normalization
     json_file = fn + '.deeprad'
 
+    if os.path.isfile(json_file):
+        # read image data from file directly as float32 (scl_slope/scl_inter are applied by nibabel)
+        data = np.asarray(nii.dataobj, dtype=np.float32)
+    else:
+        # pre-normalized data is returned as stored. Uncompressed .nii files are memory mapped, so
+        # the data is only read when it is copied into the stacked volume (see stack_nii_data)
+        data = np.asarray(nii.dataobj)
+
+    if data.ndim is 4: # handle 4D input files
+        data = np.transpose( data, (3,0,1,2))
+
     if os.path.isfile(json_file):
         with open(json_file) as infile:  
             deepraddata = json.load(infile)
 
-            # apply normalization 
+            # apply normalization in place (multiplying by the reciprocal of the scale)
             if deepraddata['normtype']=='custom' or deepraddata['normtype']=='globalzscore' or deepraddata['normtype']=='volumezscore':
-                data = (data-deepraddata['norm1'])/deepraddata['norm2']
+                scale = 1.0/deepraddata['norm2']
             elif deepraddata['normtype']=='global' or deepraddata['normtype']=='volume':
-                data = (data-deepraddata['norm1'])/(deepraddata['norm2']-deepraddata['norm1'])
+                scale = 1.0/(deepraddata['norm2']-deepraddata['norm1'])
             else:
                 raise ValueError('Internal error. Invalid normtype in .deeprad file')
+            np.subtract( data, np.float32(deepraddata['norm1']), out=data )
+            np.multiply( data, np.float32(scale), out=data )
 
     else:
         warn_msg = 'No normalization info found for {}, assuming data is pre-normalized. Otherwise run deeprad_normalize'.format(fn)
@@ -0,0 +1,66 @@
+"""Numba kernels used by deeprad_nii2img
+
+The kernels are kept in their own module so that deeprad_nii2img only imports numba (and compiles
+or loads the cached kernels) when the augmentation needs them.
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def border_index( i, n, mode ):
+    """
+    Function to map a pixel index outside of [0,n) back into the image (see deeprad_nii2img.NUMBA_BORDER_MODES)
+    """
+    if i >= 0 and i < n:
+        return i
+    if mode == 0: # mirror: d c b | a b c d | c b a
+        if n == 1:
+            return 0
+        i = i % (2*n-2)
+        return i if i < n else 2*n-2-i
+    elif mode == 1: # nearest: a a a | a b c d | d d d
+        return 0 if i < 0 else n-1
+    elif mode == 2: # reflect: c b a | a b c d | d c b
+        i = i % (2*n)
+        return i if i < n else 2*n-1-i
+    else: # wrap: b c d | a b c d | a b c
+        return i % n
+
+
+@numba.njit(parallel=True, cache=True, fastmath=True)
+def warp_slices_numba( img, M, height, width, mode ):
+    """
+    Function to apply the same affine transformation to every slice of a stack of 2D images with
+    bilinear interpolation. This is used by deeprad_nii2img.warp_slices when OpenCV is not available
+
+    Parameters
+        img: The C-contiguous stack of 2D images with the slices in the last dimension (H x W x K)
+        M: The 3x3 affine matrix mapping output to input pixel coordinates
+        height, width: The size of the transformed images
+        mode: Determines how the data is extended beyond its boundaries (see deeprad_nii2img.NUMBA_BORDER_MODES)
+
+    Returns
+        The transformed stack of 2D images (height x width x K)
+    """
+    out = np.empty( (height,width,img.shape[2]), dtype=img.dtype )
+    for r in numba.prange(height):
+        for c in range(width):
+            y = M[0,0]*r + M[0,1]*c + M[0,2]
+            x = M[1,0]*r + M[1,1]*c + M[1,2]
+            y0 = int(np.floor(y))
+            x0 = int(np.floor(x))
+            fy = y - y0
+            fx = x - x0
+            ya = border_index( y0, img.shape[0], mode )
+            yb = border_index( y0+1, img.shape[0], mode )
+            xa = border_index( x0, img.shape[1], mode )
+            xb = border_index( x0+1, img.shape[1], mode )
+            w00 = (1-fy)*(1-fx)
+            w01 = (1-fy)*fx
+            w10 = fy*(1-fx)
+            w11 = fy*fx
+            for k in range(img.shape[2]):
+                out[r,c,k] = w00*img[ya,xa,k] + w01*img[ya,xb,k] + w10*img[yb,xa,k] + w11*img[yb,xb,k]
+    return out
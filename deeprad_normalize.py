@@ -17,8 +17,9 @@ folders where the NiFTI files are stored is required.
 # Please see the LICENSE file that should have been included as part of this package
 
 from PIL import Image
-from glob import glob
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, is_dataclass
 # from dynamic_tqdm import setup_logging, setup_streams_redirection
 
 import os
@@ -28,18 +29,40 @@ import shutil
 import logging
 import nibabel
 import argparse
+import functools
 import itertools
 import json
 import dynamic_tqdm
 import tqdm.auto as t_AUTO
 
 import numpy as np
+try:
+    import orjson
+except ImportError: # the .deeprad files are written with json instead
+    orjson = None
+try:
+    import numba
+except ImportError: # statistics are computed with separate numpy reductions instead
+    numba = None
+else:
+    # the root logger is set to DEBUG by dynamic_tqdm, keep the compiler messages out of the log
+    logging.getLogger('numba').setLevel(logging.WARNING)
 
 class GuiLogger(logging.Handler):
     def emit(self, record):
         text = self.edit.toPlainText()+'\n'+self.format(record)
         self.edit.setPlainText(text)  # implementation of append_line omitted
 
+@dataclass
+class NormRec:
+    """
+    Normalization information of a single NifTI file, as stored in its .deeprad file
+    """
+    __slots__ = ('normtype', 'norm1', 'norm2')
+    normtype: str
+    norm1: float
+    norm2: float
+
 def arg_parser():
     """
     Function to return the command line argument parse for deeprad_normalize
@@ -57,6 +80,8 @@ def arg_parser():
     parser.add_argument('--scale',type=float,default=1.0,help='user-specified scale factor to apply')
     parser.add_argument('--cropabove',type=float,default=100.0,help='crop pixel values above (greater than) the specified percentile [e.g., 95]. Note: does not apply to Z score normalizations.')
     parser.add_argument('--cropbelow',type=float,default=0.0,help='crop pixel values below (greater than) the specified percentile [e.g., 5]. Note: does not apply to Z score normalizations.')
+    parser.add_argument('--workers',type=int,default=min(4,os.cpu_count() or 1),help='number of threads used to read and process files. Each worker holds one volume in memory. With 1, the next file is read in the background while the current one is processed, which holds two volumes (default: the number of CPUs, at most 4)')
+    parser.add_argument('--update',action='store_true',help='skip files whose .deeprad file is newer than the NifTI file (only for --volumenorm and --volumezscore, and only when the options are unchanged since the previous run)')
     return parser
 
 def glob_nii(folder):
@@ -69,12 +94,236 @@ def glob_nii(folder):
     Returns
         A sorted list of .nii and/or .nii.gz files in folder
     """
-    return sorted(glob(os.path.join(folder,'*.nii.gz'),recursive=True)) + sorted(glob(os.path.join(folder,'*.nii'),recursive=True))
+    # list the folder once and split by extension (.nii.gz files are listed first, as before).
+    # Hidden files (e.g. ._*.nii.gz AppleDouble files) are skipped, as glob('*.nii*') did
+    nii_gz_files, nii_files = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.name.endswith('.nii.gz') and entry.is_file():
+                nii_gz_files.append(os.path.join(folder,entry.name))
+            elif entry.name.endswith('.nii') and entry.is_file():
+                nii_files.append(os.path.join(folder,entry.name))
+    return sorted(nii_gz_files) + sorted(nii_files)
 
 def main():
     args = arg_parser().parse_args()
     process_norm(args)
 
+def is_up_to_date(curr_file):
+    """
+    Function to check whether the .deeprad file of a NifTI file was written after the NifTI file was last modified
+
+    Parameters
+        curr_file: The input file name of the NifTI image (.nii or .nii.gz file)
+
+    Returns
+        True if the .deeprad file exists and is not older than the NifTI file
+    """
+    try:
+        return os.path.getmtime(curr_file + '.deeprad') >= os.path.getmtime(curr_file)
+    except FileNotFoundError:
+        return False
+
+def write_deeprad(json_file, deepraddata):
+    """
+    Function to write normalization information to a .deeprad (JSON) file
+
+    Parameters
+        json_file: The output file name (the NifTI file name with .deeprad appended)
+        deepraddata: The normalization information (a NormRec or a dict)
+    """
+    if orjson is not None:
+        # orjson serializes dataclasses directly
+        payload = orjson.dumps(deepraddata)
+    else:
+        if is_dataclass(deepraddata):
+            deepraddata = asdict(deepraddata)
+        payload = json.dumps(deepraddata).encode()
+
+    # write the few bytes with a single system call instead of through a Python file object
+    fd = os.open(json_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, payload)
+    finally:
+        os.close(fd)
+
+def get_volume_stats(curr_file, args):
+    """
+    Function to compute the normalization factors of a single NifTI file. This runs in a worker thread
+
+    Parameters
+        curr_file: The input file name of the NifTI image (.nii or .nii.gz file)
+        args: The command line options (see arg_parser)
+
+    Returns
+        A tuple (norm1, norm2, count) with the --cropbelow and --cropabove percentiles for [0,1] normalizations
+        or the mean and standard deviation for Z score normalizations, and the number of voxels
+    """
+    # keep the file open so that slices of compressed files are read sequentially. Uncompressed files
+    # are read directly rather than memory mapped, which is much faster for reading whole volumes
+    curr_nii = nibabel.load(curr_file, mmap=False, keep_file_open=True)
+    return get_data_stats(curr_nii.dataobj, args)
+
+def get_data_stats(dataobj, args):
+    """
+    Function to compute the normalization factors of the data of a single NifTI file
+
+    Parameters
+        dataobj: The array proxy of the NifTI image (nibabel's dataobj) or the image data itself
+        args: The command line options (see arg_parser)
+
+    Returns
+        A tuple (norm1, norm2, count), see get_volume_stats
+    """
+    if args.volumenorm or args.globalnorm:
+        # read image data in its stored dtype: nibabel only converts to float when scl_slope/scl_inter
+        # have to be applied, so the percentiles of unscaled integer (CT/MR) images are found on the integers
+        curr_data = np.asarray(dataobj)
+        curr_min, curr_max = get_percentiles(curr_data,[args.cropbelow,args.cropabove])
+        return float(curr_min), float(curr_max), curr_data.size
+    else:
+        return get_mean_std(dataobj)
+
+def load_volume(curr_file):
+    """
+    Function to read the image data of a NifTI file (scl_slope/scl_inter are applied by nibabel)
+
+    Parameters
+        curr_file: The input file name of the NifTI image (.nii or .nii.gz file)
+
+    Returns
+        The image data
+    """
+    return np.asarray(nibabel.load(curr_file, mmap=False).dataobj)
+
+def get_prefetched_stats(indata, args, loader):
+    """
+    Function to compute the normalization factors of all files, reading the next file in a background
+    thread while the factors of the current file are computed (at most two volumes are held in memory)
+
+    Parameters
+        indata: The input file names of the NifTI images
+        args: The command line options (see arg_parser)
+        loader: The executor in which the files are read
+
+    Returns
+        A generator of tuples (norm1, norm2, count) in the order of indata, see get_volume_stats
+    """
+    if len(indata) == 0:
+        return
+    next_data = loader.submit(load_volume, indata[0])
+    for i in range(len(indata)):
+        curr_data = next_data.result()
+        if i+1 < len(indata):
+            next_data = loader.submit(load_volume, indata[i+1])
+        yield get_data_stats(curr_data, args)
+
+if numba is not None:
+    # nogil lets the worker threads of process_norm run the kernel concurrently. The kernel itself is
+    # serial (SIMD only) since numba's default threading layer does not support calls from several threads
+    @numba.njit(nogil=True, fastmath=True, cache=True)
+    def get_fused_stats(data):
+        """
+        Function to compute the sum, sum of squares, minimum and maximum of 1D data in a single pass
+
+        Parameters
+            data: The (flattened) image data
+
+        Returns
+            A tuple (sum, sum of squares, minimum, maximum)
+        """
+        total = 0.0
+        total_sq = 0.0
+        data_min = data[0]
+        data_max = data[0]
+        for i in range(data.size):
+            v = data[i]
+            total += v
+            total_sq += float(v)*v
+            data_min = min(data_min, v)
+            data_max = max(data_max, v)
+        return total, total_sq, data_min, data_max
+else:
+    def get_fused_stats(data):
+        """
+        Function to compute the sum, sum of squares, minimum and maximum of 1D data
+
+        Parameters
+            data: The (flattened) image data
+
+        Returns
+            A tuple (sum, sum of squares, minimum, maximum)
+        """
+        # accumulate in float64 (float32 sums lose precision and integer products would overflow)
+        data64 = data.astype(np.float64, copy=False)
+        return data64.sum(), np.dot(data64,data64), data.min(), data.max()
+
+def get_percentiles(data, q, max_samples=200000):
+    """
+    Function to compute percentiles of image data. The minimum (0) and maximum (100) are found
+    in a single pass. For large volumes, other percentiles are estimated from a fixed random
+    subsample of the voxels, which is well within the precision needed for normalization
+
+    Parameters
+        data: The image data
+        q: The percentiles to compute (between 0 and 100)
+        max_samples: The number of voxels above which the percentiles are estimated from a subsample
+
+    Returns
+        The requested percentiles
+    """
+    # the voxel order does not matter, order='K' returns a view of the (Fortran ordered) NifTI data
+    data = data.ravel(order='K')
+    inner_q = [curr_q for curr_q in q if 0 < curr_q < 100]
+    if len(inner_q) < len(q):
+        _, _, data_min, data_max = get_fused_stats(data)
+    if inner_q:
+        if data.size > max_samples:
+            data = data[np.random.default_rng(0).integers(0,data.size,max_samples)]
+        # all percentiles are found with a single partition of the data
+        inner_values = iter(np.percentile(data,inner_q))
+
+    out = []
+    for curr_q in q:
+        if curr_q <= 0:
+            out.append(data_min)
+        elif curr_q >= 100:
+            out.append(data_max)
+        else:
+            out.append(next(inner_values))
+    return out
+
+def get_mean_std(dataobj):
+    """
+    Function to compute the mean and standard deviation of NifTI data in a single pass, reading one
+    slice (along the last dimension) at a time so that the whole volume is never held in memory.
+    Slices are reduced in their stored dtype, the sums are accumulated in float64
+
+    Parameters
+        dataobj: The array proxy of the NifTI image (nibabel's dataobj)
+
+    Returns
+        A tuple (mean, std, count) over all voxels
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for z in range(dataobj.shape[-1]):
+        curr_slice = np.asarray(dataobj[...,z]).ravel(order='K')
+        curr_count = curr_slice.size
+        curr_sum, curr_sum_sq, _, _ = get_fused_stats(curr_slice)
+        curr_mean = curr_sum/curr_count
+        curr_m2 = max( curr_sum_sq - curr_sum*curr_mean, 0.0 )
+
+        # combine the running statistics with those of this slice (Chan et al.)
+        delta = curr_mean - mean
+        total = count + curr_count
+        mean += delta*curr_count/total
+        m2 += curr_m2 + delta*delta*count*curr_count/total
+        count = total
+
+    return float(mean), float(np.sqrt(m2/count)), count
+
 def process_norm(args):
     #
     # logger = logging.getLogger()
@@ -105,44 +354,60 @@ def process_norm(args):
     _logger.setLevel(logging.DEBUG)
 
     tabs = ''
-    indata = list( itertools.chain.from_iterable( [ glob_nii(f) for f in args.folder ] ) )
+    # list the folders concurrently (directory listings are slow on network file systems)
+    with ThreadPoolExecutor(max_workers=min(32,max(len(args.folder),1))) as executor:
+        indata = list( itertools.chain.from_iterable( executor.map(glob_nii, args.folder) ) )
     # logger.info(args.folder)
 
     _logger.info(tabs+'deeprad_normalize -- a tool to write applicaiton-specific normalization information to Nifti headers')
     _logger.info(tabs+'{} files were found in {} folder(s)'.format(len(indata),len(args.folder)))
 
-    # for global normalization we need to keep track data ranges
-    globaldata_norm1 = np.zeros(len(indata))
-    globaldata_norm2 = np.zeros(len(indata))
+    if args.update:
+        if args.volumenorm or args.volumezscore:
+            num_found = len(indata)
+            indata = [curr_file for curr_file in indata if not is_up_to_date(curr_file)]
+            _logger.info(tabs+'{} files are up to date and will be skipped'.format(num_found-len(indata)))
+        else:
+            # global factors depend on every file, custom factors do not require reading the files
+            _logger.warning(tabs+'--update only applies to volume-wise normalizations, all files will be processed')
+
+    # keep track of the data ranges of each volume. Every file is read once, in a single pass,
+    # and the volume-wise factors are reused when the .deeprad files are written (so they are kept in float64)
+    globaldata_norm1 = np.empty(len(indata), dtype=np.float64)
+    globaldata_norm2 = np.empty(len(indata), dtype=np.float64)
+    globaldata_count = np.empty(len(indata), dtype=np.int64)
 
     if args.customnorm:
         _logger.info(tabs+'Applying custom normalization (shift={}, scale={})...'.format(args.shift,args.scale))
-    elif args.volumenorm:
+    elif args.volumenorm or args.volumezscore:
         _logger.info(tabs+'Computing volume-wise normalization...')
     elif args.globalnorm or args.globalzscore:
         _logger.info(tabs+'Computing global normalization...')
-        # loop through all of the files
-        #for curr_file in indata:
-        for i in tqdm(range(len(indata)),desc='Determining global scaling factors'):
-            curr_file = indata[i]
-            curr_nii = nibabel.load(curr_file)
-            curr_data = curr_nii.get_fdata()
-
-            if args.globalnorm:
-                globaldata_norm1[i] = np.percentile(curr_data,args.cropbelow)
-                globaldata_norm2[i] = np.percentile(curr_data,args.cropabove)
-            elif args.globalzscore:
-                globaldata_norm1[i] = np.mean(curr_data)
-                globaldata_norm2[i] = np.std(curr_data)
 
+    if args.volumenorm or args.volumezscore or args.globalnorm or args.globalzscore:
+        # files are read and processed in parallel, results are returned in the order of indata
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            if args.workers == 1:
+                # overlap reading (and decompressing) the next file with processing the current one
+                volume_stats = get_prefetched_stats(indata, args, executor)
+            else:
+                volume_stats = executor.map(functools.partial(get_volume_stats, args=args), indata)
+            for i, (norm1, norm2, count) in enumerate(tqdm(volume_stats,total=len(indata),desc='Determining scaling factors')):
+                globaldata_norm1[i] = norm1
+                globaldata_norm2[i] = norm2
+                globaldata_count[i] = count
+
+    if args.globalnorm or args.globalzscore:
         if args.globalnorm:
-            global_min = np.min(globaldata_norm1)
-            global_max = np.max(globaldata_norm2)
+            global_min = float(np.min(globaldata_norm1))
+            global_max = float(np.max(globaldata_norm2))
             _logger.info(tabs+' Global min = {} (@ {}%-ile)'.format(global_min,args.cropbelow))
             _logger.info(tabs+' Global max = {} (@ {}%-ile)'.format(global_max,args.cropabove))
         elif args.globalzscore:
-            global_mean = np.mean(globaldata_norm1)
-            global_std = np.std(globaldata_norm2)
+            # pool the volume-wise means and standard deviations, weighted by the number of voxels
+            weights = globaldata_count / np.sum(globaldata_count)
+            global_mean = float(np.sum(weights*globaldata_norm1))
+            global_std = float(np.sqrt(np.sum(weights*(globaldata_norm2**2 + (globaldata_norm1-global_mean)**2))))
             _logger.info(tabs+' Global mean= {}'.format(global_mean))
             _logger.info(tabs+' Global std= {}'.format(global_std))
 
@@ -155,49 +420,27 @@ def process_norm(args):
 
         json_file = curr_file + '.deeprad'
 
-        deepraddata = {}
-        
         # calculate normalization
         if args.volumenorm: # volumewise normalization
-            curr_nii = nibabel.load(curr_file)
-            curr_data = curr_nii.get_fdata()
-
-            curr_min = np.percentile(curr_data,args.cropbelow)
-            curr_max = np.percentile(curr_data,args.cropabove)
-
-            deepraddata['normtype'] = 'volume'
-            deepraddata['norm1'] = curr_min
-            deepraddata['norm2'] = curr_max
+            deepraddata = NormRec('volume', float(globaldata_norm1[i]), float(globaldata_norm2[i]))
 
         elif args.volumezscore: # volumewise Z score
-            curr_nii = nibabel.load(curr_file)
-            curr_data = curr_nii.get_fdata()
-
-            curr_mean = np.mean(curr_data)
-            curr_std = np.std(curr_data)
-
-            deepraddata['normtype'] = 'volumezscore'
-            deepraddata['norm1'] = curr_mean
-            deepraddata['norm2'] = curr_std            
+            deepraddata = NormRec('volumezscore', float(globaldata_norm1[i]), float(globaldata_norm2[i]))
 
         elif args.globalnorm: # global normalization
-            deepraddata['normtype'] = 'global'
-            deepraddata['norm1'] = global_min
-            deepraddata['norm2'] = global_max   
+            deepraddata = NormRec('global', global_min, global_max)
 
-        elif args.globalnorm: # global Z score
-            deepraddata['normtype'] = 'globalzscore'
-            deepraddata['norm1'] = global_mean
-            deepraddata['norm2'] = global_std  
+        elif args.globalzscore: # global Z score
+            deepraddata = NormRec('globalzscore', global_mean, global_std)
 
         elif args.customnorm: # custom normalization
-            deepraddata['normtype'] = 'custom'
-            deepraddata['norm1'] = args.shift
-            deepraddata['norm2'] = args.scale
+            deepraddata = NormRec('custom', float(args.shift), float(args.scale))
+
+        else: # no normalization, an empty .deeprad file is written
+            deepraddata = {}
 
         # write to deeprad json file
-        with open(json_file, 'w') as outfile:  
-            json.dump(deepraddata, outfile)
+        write_deeprad(json_file, deepraddata)
 
         _logger.info('Processing {}/{}: {}'.format(i,len(indata),curr_file))
 
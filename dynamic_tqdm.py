@@ -1,8 +1,7 @@
-from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, Qt
-from PyQt5.QtWidgets import QLineEdit, QTextBrowser
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, Qt, QTimer
+from PyQt5.QtWidgets import QLineEdit, QPlainTextEdit
 from PyQt5.QtGui import QTextCursor
 # from MyPyQtGUI import MainApp
-from queue import Queue
 
 import logging
 import datetime
@@ -12,47 +11,52 @@ import sys
 
 import tqdm.auto as t_AUTO
 
-IS_SETUP_DONE = 'is_setup_done'
+# text received by the GUI widgets is rendered at most once per interval (in milliseconds)
+GUI_FLUSH_INTERVAL_MS = 50
+# the oldest lines of the log widget are dropped beyond this number of lines
+GUI_MAX_LOG_LINES = 10000
 
-TQDM_WRITE_STREAM_CONFIG = 'TQDM_WRITE_STREAM_CONFIG'
-STDOUT_WRITE_STREAM_CONFIG = 'STDOUT_WRITE_STREAM_CONFIG'
-IS_STREAMS_REDIRECTION_SETUP_DONE = 'IS_STREAMS_REDIRECTION_SETUP_DONE'
+class DynamicTqdmConfig(object):
+    # module state of the logging and stream redirection setup
+    __slots__ = ('is_setup_done', 'is_streams_redirection_setup_done', 'tqdm_write_stream', 'stdout_write_stream')
 
-STREAM_CONFIG_KEY_QUEUE = 'queue'
-STREAM_CONFIG_KEY_STREAM = 'write_stream'
-STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER = 'qt_queue_receiver'
-
-default_config_dict = {
-    IS_SETUP_DONE: False,
-    IS_STREAMS_REDIRECTION_SETUP_DONE: False,
-    TQDM_WRITE_STREAM_CONFIG: None,
-    STDOUT_WRITE_STREAM_CONFIG: None,
-}
-
-config_dict = default_config_dict
-
-# DEFINITION NEEDED FIRST ...
-class WriteStream(object):
-    def __init__(self, q: Queue):
-        self.queue = q
-
-    def write(self, text):
-        self.queue.put(text)
+    def __init__(self):
+        self.is_setup_done = False
+        self.is_streams_redirection_setup_done = False
+        self.tqdm_write_stream = None
+        self.stdout_write_stream = None
 
-    def flush(self):
-        pass
+config = DynamicTqdmConfig()
 
 class WhitespaceRemovingFormatter(logging.Formatter):
-    def format(self, record):
-        record.msg = record.msg.strip()
-        return super(WhitespaceRemovingFormatter, self).format(record)
+    # (second, datefmt, formatted time) of the last record
+    _cached_time = None
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt is None:
+            # the default format includes milliseconds
+            return super(WhitespaceRemovingFormatter, self).formatTime(record, datefmt)
+        # date formats have a resolution of one second, records logged in a loop share the formatted time
+        second = int(record.created)
+        cached = self._cached_time
+        if cached is not None and cached[0] == second and cached[1] == datefmt:
+            return cached[2]
+        text = super(WhitespaceRemovingFormatter, self).formatTime(record, datefmt)
+        self._cached_time = (second, datefmt, text)
+        return text
+
+    def formatMessage(self, record):
+        # strip the message text once it is formatted. record.msg is left untouched since the record is
+        # shared by all handlers and msg may not be a string (record.message is rebuilt by each formatter)
+        record.message = record.message.strip()
+        return super(WhitespaceRemovingFormatter, self).formatMessage(record)
 
 def setup_logging(log_prefix, force_debug_level=logging.DEBUG):
 
     root = logging.getLogger()
     root.setLevel(force_debug_level)
 
-    if config_dict[IS_SETUP_DONE]:
+    if config.is_setup_done:
         pass
     else:
         __log_file_name = "{}-{}_log_file.txt".format(log_prefix,
@@ -76,7 +80,7 @@ def setup_logging(log_prefix, force_debug_level=logging.DEBUG):
         tqdm_handler.setFormatter(console_formatter)
         root.addHandler(tqdm_handler)
 
-        config_dict[IS_SETUP_DONE] = True
+        config.is_setup_done = True
 
 
 class TqdmLoggingHandler(logging.StreamHandler):
@@ -85,18 +89,27 @@ class TqdmLoggingHandler(logging.StreamHandler):
 
     def emit(self, record):
         msg = self.format(record)
-        tqdm.tqdm.write(msg)
-        self.flush()
+        if config.is_streams_redirection_setup_done:
+            # progress bars have their own widget, so there is no bar to clear and redraw around the
+            # message: skip tqdm.write (and its lock) and write to the redirected stdout directly
+            config.stdout_write_stream.write(msg + '\n')
+        else:
+            tqdm.tqdm.write(msg)
 
 
 
 
-class QueueWriteStream(object):
-    def __init__(self, q: Queue):
-        self.queue = q
+class SignalWriteStream(QObject):
+    # connect with Qt.QueuedConnection, the text is then delivered in the thread of the receiving widget
+    text_written = pyqtSignal(str)
+
+    def __init__(self, *args, **kwargs):
+        QObject.__init__(self, *args, **kwargs)
+        # bind once, write() is called for every chunk of redirected output
+        self._emit = self.text_written.emit
 
     def write(self, text):
-        self.queue.put(text)
+        self._emit(text)
 
     def flush(self):
         pass
@@ -117,17 +130,17 @@ def perform_tqdm_default_out_stream_hack(tqdm_file_stream, tqdm_nb_columns=None)
                      unit_scale=False, dynamic_ncols=False, smoothing=0.3,
                      bar_format=None, initial=0, position=None, postfix=None,
                      unit_divisor=1000, gui=False, **kwargs):
-            super(TQDMPatch, self).__init__(iterable, desc, total, leave,
-                                            tqdm_file_stream,  # change any chosen file stream with our's
-                                            tqdm_nb_columns,  # change nb of columns (gui choice),
-                                            mininterval, maxinterval,
-                                            miniters, ascii, disable, unit,
-                                            unit_scale,
-                                            False,  # change param
-                                            smoothing,
-                                            bar_format, initial, position, postfix,
-                                            unit_divisor, gui, **kwargs)
-            print('TQDM Patch called')  # check it works
+            # keyword arguments, the positional order of tqdm's parameters differs between versions
+            super(TQDMPatch, self).__init__(iterable=iterable, desc=desc, total=total, leave=leave,
+                                            file=tqdm_file_stream,  # change any chosen file stream with our's
+                                            ncols=tqdm_nb_columns,  # change nb of columns (gui choice),
+                                            mininterval=mininterval, maxinterval=maxinterval,
+                                            miniters=miniters, ascii=ascii, disable=disable, unit=unit,
+                                            unit_scale=unit_scale,
+                                            dynamic_ncols=False,  # change param
+                                            smoothing=smoothing,
+                                            bar_format=bar_format, initial=initial, position=position, postfix=postfix,
+                                            unit_divisor=unit_divisor, gui=gui, **kwargs)
 
         @classmethod
         def write(cls, s, file=None, end="\n", nolock=False):
@@ -147,87 +160,60 @@ def perform_tqdm_default_out_stream_hack(tqdm_file_stream, tqdm_nb_columns=None)
 
 
 def setup_streams_redirection(tqdm_nb_columns=None):
-    if config_dict[IS_STREAMS_REDIRECTION_SETUP_DONE]:
+    if config.is_streams_redirection_setup_done:
         pass
     else:
         configure_tqdm_redirection(tqdm_nb_columns)
         configure_std_out_redirection()
-        config_dict[IS_STREAMS_REDIRECTION_SETUP_DONE] = True
+        config.is_streams_redirection_setup_done = True
 
 
 def configure_std_out_redirection():
-    queue_std_out = Queue()
-    config_dict[STDOUT_WRITE_STREAM_CONFIG] = {
-        STREAM_CONFIG_KEY_QUEUE: queue_std_out,
-        STREAM_CONFIG_KEY_STREAM: QueueWriteStream(queue_std_out),
-        STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER: StdOutTextQueueReceiver(q=queue_std_out)
-    }
+    config.stdout_write_stream = SignalWriteStream()
     perform_std_out_hack()
 
 
 def perform_std_out_hack():
-    sys.stdout = config_dict[STDOUT_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_STREAM]
+    sys.stdout = config.stdout_write_stream
 
 
 def configure_tqdm_redirection(tqdm_nb_columns=None):
-    queue_tqdm = Queue()
-    config_dict[TQDM_WRITE_STREAM_CONFIG] = {
-        STREAM_CONFIG_KEY_QUEUE: queue_tqdm,
-        STREAM_CONFIG_KEY_STREAM: QueueWriteStream(queue_tqdm),
-        STREAM_CONFIG_KEY_QT_QUEUE_RECEIVER: TQDMTextQueueReceiver(q=queue_tqdm)
-    }
+    config.tqdm_write_stream = SignalWriteStream()
     perform_tqdm_default_out_stream_hack(
-        tqdm_file_stream=config_dict[TQDM_WRITE_STREAM_CONFIG][STREAM_CONFIG_KEY_STREAM],
+        tqdm_file_stream=config.tqdm_write_stream,
         tqdm_nb_columns=tqdm_nb_columns)
 
 
-class StdOutTextQueueReceiver(QObject):
-    # we are forced to define 1 signal per class
-    # see https://stackoverflow.com/questions/50294652/how-to-create-pyqtsignals-dynamically
-    queue_std_out_element_received_signal = pyqtSignal(str)
-
-    def __init__(self, q: Queue, *args, **kwargs):
-        QObject.__init__(self, *args, **kwargs)
-        self.queue = q
-
-    @pyqtSlot()
-    def run(self):
-        self.queue_std_out_element_received_signal.emit('---> STD OUT Queue reception Started <---\n')
-        while True:
-            text = self.queue.get()
-            self.queue_std_out_element_received_signal.emit(text)
-
-
-class TQDMTextQueueReceiver(QObject):
-    # we are forced to define 1 signal per class
-    # see https://stackoverflow.com/questions/50294652/how-to-create-pyqtsignals-dynamically
-    queue_tqdm_element_received_signal = pyqtSignal(str)
-
-    def __init__(self, q: Queue, *args, **kwargs):
-        QObject.__init__(self, *args, **kwargs)
-        self.queue = q
-
-    @pyqtSlot()
-    def run(self):
-        # we assume that all TQDM outputs start with \r, so use that to show stream reception is started
-        self.queue_tqdm_element_received_signal.emit('\r---> TQDM Queue reception Started <---\n')
-        while True:
-            text = self.queue.get()
-            self.queue_tqdm_element_received_signal.emit(text)
-
-class StdOutTextEdit(QTextBrowser):
+class StdOutTextEdit(QPlainTextEdit):
     def __init__(self, parent):
-        super(QTextBrowser, self).__init__(parent)
+        super(StdOutTextEdit, self).__init__(parent)
         # self.setParent(parent)
         self.setReadOnly(True)
+        # plain text (no rich text layout) with a bounded length keeps appending cheap
+        self.setMaximumBlockCount(GUI_MAX_LOG_LINES)
         # self.setLineWidth(50)
         # self.setMinimumWidth(500)
         # self.setFont(QFont('Consolas', 11))
+        # text is buffered and inserted in one piece when the timer fires
+        self._buffer = []
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(GUI_FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self.flush_text)
 
     @pyqtSlot(str)
     def append_text(self, text: str):
-        self.moveCursor(QTextCursor.End)
-        self.insertPlainText(text)
+        self._buffer.append(text)
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @pyqtSlot()
+    def flush_text(self):
+        if self._buffer:
+            text = ''.join(self._buffer)
+            self._buffer.clear()
+            self.moveCursor(QTextCursor.End)
+            self.insertPlainText(text)
 
 
 class StdTQDMTextEdit(QLineEdit):
@@ -236,6 +222,12 @@ class StdTQDMTextEdit(QLineEdit):
         self.setParent(parent)
         self.setReadOnly(True)
         self.setEnabled(True)
+        # only the latest TQDM frame is rendered when the timer fires
+        self._pending = None
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(GUI_FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self.flush_tqdm_text)
         # self.setMinimumWidth(500)
         # self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
         # self.setClearButtonEnabled(True)
@@ -243,15 +235,25 @@ class StdTQDMTextEdit(QLineEdit):
 
     @pyqtSlot(str)
     def set_tqdm_text(self, text: str):
-        new_text = text
-        if new_text.find('\r') >= 0:
-            new_text = new_text.replace('\r', '').rstrip()
-            if new_text:
-                self.setText(new_text)
+        if text.find('\r') >= 0:
+            # a batch may hold several TQDM frames, only the last one is shown
+            for new_text in reversed(text.split('\r')[1:]):
+                new_text = new_text.rstrip()
+                if new_text:
+                    self._pending = new_text
+                    if not self._flush_timer.isActive():
+                        self._flush_timer.start()
+                    break
         else:
             # we suppose that all TQDM prints have \r, so drop the rest
             pass
 
+    @pyqtSlot()
+    def flush_tqdm_text(self):
+        if self._pending is not None:
+            self.setText(self._pending)
+            self._pending = None
+
 class LongProcedureWrapper(QObject):
     def __init__(self, main_app):
         super(LongProcedureWrapper, self).__init__()
@@ -2,25 +2,32 @@
 import deeprad_normalize as dr_norm
 import deeprad_nii2img as dr_n2i
 from types import SimpleNamespace
-from global_dict.w_global import gbl_get_value
+from operator import attrgetter
 
 import numpy as np
 
-def deeprad_backend_norm():
+# the normalization radio buttons in the order vn, gn, vz, gz, cn, nn
+NORM_RADIO_GETTER = attrgetter('norm_radio_vn', 'norm_radio_gn', 'norm_radio_vz',
+                               'norm_radio_gz', 'norm_radio_cn', 'norm_radio_nn')
 
-    ui = gbl_get_value("ui")
+def text_to_int(widget):
+    # the integer in a text field, or None if the field is empty or invalid
+    try:
+        return int(widget.text())
+    except ValueError:
+        return None
+
+def get_norm_args(ui):
+    # read the normalization settings from the widgets. This must run in the GUI thread, the
+    # returned arguments are then passed to dr_norm.process_norm in a worker thread
 
     # QtWidgets.QMessageBox.information(ui.button_start, "test", "I am in the glue!")
 
-    value_folder = ui.norm_folder.toPlainText().split('\n')
-    value_vn = ui.norm_radio_vn.isChecked()
-    value_gn = ui.norm_radio_gn.isChecked()
-    value_vz = ui.norm_radio_vz.isChecked()
-    value_gz = ui.norm_radio_gz.isChecked()
-    value_cn = ui.norm_radio_cn.isChecked()
-    value_nn = ui.norm_radio_nn.isChecked()
+    # one folder per line, blank lines (e.g. after a trailing newline) are ignored
+    value_folder = [folder for folder in ui.norm_folder.toPlainText().splitlines() if folder.strip()]
+    value_vn, value_gn, value_vz, value_gz, value_cn, value_nn = [radio.isChecked() for radio in NORM_RADIO_GETTER(ui)]
 
-    if ui.norm_radio_cn.isChecked():
+    if value_cn:
         value_shift = float(ui.norm_text_shift.text())
         value_scale = float(ui.norm_text_scale.text())
         value_cropa = float(ui.norm_text_cropa.text())
@@ -42,52 +49,29 @@ def deeprad_backend_norm():
                            scale=value_scale,
                            cropabove=value_cropa,
                            cropbelow=value_cropb,
+                           workers=1,
+                           update=False,
                            log_output=ui.norm_log_text)
-    dr_norm.process_norm(args)
+    return args
 
 
-def deeprad_backend_n2i():
-
-    ui = gbl_get_value("ui")
+def get_n2i_args(ui):
+    # read the nii2img settings from the widgets. This must run in the GUI thread, the
+    # returned arguments are then passed to dr_n2i.process_n2i in a worker thread
 
     value_outfolder = ui.n2i_folder_output.toPlainText()
     value_X = [ui.n2i_folder_X.toPlainText()]
     value_Y = [ui.n2i_folder_Y.toPlainText()]
 
-    try:
-        value_axes = [int(ui.n2i_text_axes.text())]
-    except ValueError:
-        value_axes = None
-
-    try:
-        value_imsize_w = int(ui.n2i_text_imsize_w.text())
-    except ValueError:
-        value_imsize_w = None
-
-    try:
-        value_imsize_h = int(ui.n2i_text_imsize_h.text())
-    except ValueError:
-        value_imsize_h = None
-
-    try:
-        value_testfraction = int(ui.n2i_text_testfraction.text())
-    except ValueError:
-        value_testfraction = None
-
-    try:
-        value_valfraction = int(ui.n2i_text_valfraction.text())
-    except ValueError:
-        value_valfraction = None
-
-    try:
-        value_Xslices = int(ui.n2i_text_xslices.text())
-    except ValueError:
-        value_Xslices = None
-
-    try:
-        value_Yslices = int(ui.n2i_text_yslices.text())
-    except ValueError:
-        value_Yslices = None
+    value_axes = text_to_int(ui.n2i_text_axes)
+    if value_axes is not None:
+        value_axes = [value_axes]
+    value_imsize_w = text_to_int(ui.n2i_text_imsize_w)
+    value_imsize_h = text_to_int(ui.n2i_text_imsize_h)
+    value_testfraction = text_to_int(ui.n2i_text_testfraction)
+    value_valfraction = text_to_int(ui.n2i_text_valfraction)
+    value_Xslices = text_to_int(ui.n2i_text_xslices)
+    value_Yslices = text_to_int(ui.n2i_text_yslices)
 
     value_force = ui.n2i_check_force.isChecked()
     value_shuffle = ui.n2i_check_shuffle.isChecked()
@@ -152,7 +136,10 @@ def deeprad_backend_n2i():
                            hflips=value_hflips,
                            vflips=value_vflips,
                            augmode=value_augmode,
+                           device='cpu',
+                           workers=1,
+                           output_format='tiff',
                            log_output=ui.n2i_log_text)
 
     # np.save('args_n2i.npy', args)
-    dr_n2i.process_n2i(args)
\ No newline at end of file
+    return args
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+from scipy.ndimage import affine_transform
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import deeprad_nii2img as dr_n2i
+
+numba_kernels = pytest.importorskip('deeprad_nii2img_numba')
+
+
+@pytest.mark.parametrize('mode', ['mirror', 'nearest', 'reflect', 'wrap'])
+def test_warp_slices_numba_matches_scipy(mode):
+    rng = np.random.default_rng(0)
+    img = rng.random((40,50,3)).astype(np.float32)
+    # rotation + anisotropic scaling + shift, sampling well outside of the image boundaries
+    t = np.deg2rad(17)
+    M = np.array([[1.1*np.cos(t),-np.sin(t),-6.3],
+                  [np.sin(t),0.9*np.cos(t),-8.2],
+                  [0,0,1]])
+    output_shape = (45,55)
+    out = numba_kernels.warp_slices_numba(img, M, output_shape[0], output_shape[1], dr_n2i.NUMBA_BORDER_MODES[mode])
+    expected = np.stack([ affine_transform(img[:,:,k], M, output_shape=output_shape, order=1, mode=dr_n2i.SCIPY_BORDER_MODES[mode])
+                          for k in range(img.shape[2]) ], axis=-1)
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+
+def test_prefetch_subjects_stops_producer_when_closed(monkeypatch):
+    loaded = []
+    def load_subject(X_files, Y_files, logger):
+        loaded.append(X_files)
+        return X_files, Y_files
+    monkeypatch.setattr(dr_n2i, 'load_subject', load_subject)
+    jobs = [ (i, [], 'X{}'.format(i), 'Y{}'.format(i)) for i in range(50) ]
+    prefetched = dr_n2i.prefetch_subjects(jobs, logging.getLogger(), maxsize=2)
+    assert next(prefetched)[0] == jobs[0]
+    # stop consuming while the producer is blocked on the full queue
+    time.sleep(0.2)
+    prefetched.close()
+    time.sleep(0.5)
+    assert not any( t.name.endswith('(producer)') and t.is_alive() for t in threading.enumerate() )
+    assert len(loaded) < len(jobs)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from types import SimpleNamespace
+
+import nibabel
+import numpy as np
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import deeprad_normalize as dr_norm
+
+
+def norm_args(folder, **kwargs):
+    args = dict(folder=[str(folder)], volumenorm=False, globalnorm=False, volumezscore=False,
+                globalzscore=False, customnorm=False, nonorm=False, shift=0.0, scale=1.0,
+                cropabove=100.0, cropbelow=0.0, workers=2, update=False, log_output=None)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_globalzscore_matches_concatenated_volumes(tmp_path, monkeypatch, workers):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    volumes = []
+    # volumes of different sizes, means and spreads
+    for i, (shape, mean, std) in enumerate([((16,16,8), 1000.0, 10.0), ((20,12,5), 1200.0, 50.0), ((8,8,30), 900.0, 5.0)]):
+        data = (mean + std*rng.standard_normal(shape)).astype(np.float32)
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), str(tmp_path / 'v{}.nii.gz'.format(i)))
+        volumes.append(data.astype(np.float64).ravel())
+
+    dr_norm.process_norm(norm_args(tmp_path, globalzscore=True, workers=workers))
+
+    all_data = np.concatenate(volumes)
+    for i in range(len(volumes)):
+        with open(str(tmp_path / 'v{}.nii.gz.deeprad'.format(i))) as infile:
+            deepraddata = json.load(infile)
+        assert deepraddata['normtype'] == 'globalzscore'
+        assert deepraddata['norm1'] == pytest.approx(np.mean(all_data), rel=1e-9)
+        assert deepraddata['norm2'] == pytest.approx(np.std(all_data), rel=1e-6)